@@ -1,23 +1,258 @@
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
+try:
+    import orjson
+except ImportError:  # Optional speedup; fall back to the standard library
+    orjson = None
+try:
+    import zstandard as zstd
+except ImportError:  # Optional; compressed downloads are offered only when installed
+    zstd = None
 import csv
 import io
+import os
 import logging
+from logging.handlers import RotatingFileHandler
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
 from datetime import datetime, date, time, timedelta
 
 # --- 1. Logging Configuration ---
-# Set up logging to a file for debugging by the app administrator
-logging.basicConfig(
-    filename='app_errors.log',
-    level=logging.ERROR,
-    format='%(asctime)s - %(levelname)s - %(message)s'
-)
+# Set up logging to a size-capped, rotating file for debugging by the app administrator
+def configure_logging(filename='app_errors.log'):
+    """Attaches the rotating error-log handler unless the root logger already has one for this file.
+    Streamlit re-runs this script on every interaction, and two handlers on one file would duplicate records and break rotation."""
+    root_logger = logging.getLogger()
+    log_path = os.path.abspath(filename)
+    if any(isinstance(h, RotatingFileHandler) and h.baseFilename == log_path for h in root_logger.handlers):
+        return
+    handler = RotatingFileHandler(log_path, maxBytes=10_000_000, backupCount=3)
+    handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    root_logger.setLevel(logging.ERROR)
+    root_logger.addHandler(handler)
+
+configure_logging()
 
 # --- 2. UI Configuration ---
 st.set_page_config(page_title="SolarEdge Data Downloader", layout="wide")
 
-# --- 3. Login Function ---
+# --- 3. HTTP Session ---
+@st.cache_resource
+def get_session():
+    """Returns a pooled HTTP session so repeated API calls reuse the same TLS connection."""
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=10,
+        pool_maxsize=10,
+        max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504], raise_on_status=False)
+    )
+    session.mount("https://", adapter)
+    # Attach the API key once; requests merges session params into every call
+    session.params = {'api_key': st.secrets.get("solaredge", {}).get("api_key")}
+    return session
+
+# --- 4. API Helpers ---
+BASE_URL = "https://monitoringapi.solaredge.com"
+# The monitoring API allows at most 3 concurrent calls per source IP; more only produces 429s and retry backoff
+MAX_CONCURRENT_REQUESTS = 3
+# Sensor data is fetched in one-week windows; cap the range so one click cannot spend much of the daily request quota
+MAX_SENSOR_DATA_DAYS = 31
+
+# CSV columns for endpoints with a fixed row shape (Site Details columns depend on the response)
+FIELDNAMES = {
+    "Site Energy": ('date', 'value', 'timeUnit', 'unit'),
+    "Site Power": ('date', 'value', 'timeUnit', 'unit'),
+    "Get Sensor List": ('gateway', 'name', 'measurement', 'type'),
+    "Get Sensor Data": ('gateway', 'date', 'measurement_type', 'value'),
+    "Get Meters Data": ('date', 'value', 'meterSerialNumber', 'model', 'meterType', 'timeUnit', 'unit'),
+}
+
+def api_key_configured():
+    """Checks for the API key, showing an error to the user if it is missing."""
+    if not st.secrets.get("solaredge", {}).get("api_key"):
+        st.error("API key not found in secrets. Please have the administrator configure it.")
+        return False
+    return True
+
+def fetch_json(endpoint, params=None, session=None):
+    """Performs the GET request and returns the parsed JSON, raising on any request error.
+    Makes no Streamlit calls, so it is safe to run from worker threads."""
+    full_url = f"{BASE_URL}/{endpoint}"
+    if session is None:
+        session = get_session()
+    response = session.get(full_url, params=params, timeout=(3.05, 30))
+    response.raise_for_status() # Raises an exception for 4xx or 5xx status codes
+    return parse_json(response.content, endpoint)
+
+def parse_json(content, endpoint):
+    """Parses a response body, with orjson when available, raising InvalidJSONError on a malformed body."""
+    try:
+        if orjson is not None:
+            # Parse the body bytes directly, skipping the text decode and the pure-Python tree build
+            return orjson.loads(content)
+        return json.loads(content)
+    except ValueError as e:
+        # Surface as a request error, as response.json() would, so callers handle it the same way
+        raise requests.exceptions.InvalidJSONError(f"Invalid JSON from '{endpoint}': {e}")
+
+def show_api_error(e):
+    """Displays a user-facing message for a failed API request."""
+    # --- Intelligent, User-Facing Error Logic ---
+    if e.response is not None:
+        # Check for the specific date-range error
+        response_text = e.response.text.lower()
+        if e.response.status_code == 403 and "date range" in response_text and "maximum" in response_text:
+            st.error("The date range you selected is too long for the requested Time Unit. Please select a shorter period and try again.")
+        else:
+            # Generic error for other API issues
+            st.error(f"An API error occurred (Code: {e.response.status_code}). Please check your parameters and try again.")
+    else:
+        # Error for network issues where there's no response
+        st.error("Could not connect to the SolarEdge server. Please check your network connection and try again.")
+
+def fetch_concurrently(calls):
+    """Fetches independent (endpoint, params) calls concurrently and returns the responses in order.
+    Raises the first request error; worker threads make no Streamlit calls."""
+    session = get_session()
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as executor:
+        futures = [executor.submit(fetch_json, endpoint, params, session) for endpoint, params in calls]
+    return [future.result() for future in futures]
+
+def fmt_dt(d, t):
+    """Formats a date and time as the API's 'YYYY-MM-DD hh:mm:ss' without building a datetime."""
+    return f"{d.year:04d}-{d.month:02d}-{d.day:02d} {t.hour:02d}:{t.minute:02d}:{t.second:02d}"
+
+def split_date_range(start, end, days):
+    """Splits an inclusive date range into consecutive windows of at most `days` days."""
+    windows = []
+    while start <= end:
+        window_end = min(start + timedelta(days=days - 1), end)
+        windows.append((start, window_end))
+        start = window_end + timedelta(days=1)
+    return windows
+
+def to_json_bytes(data):
+    """Serializes data to indented JSON bytes for the raw download."""
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2)
+    return json.dumps(data, indent=2).encode("utf-8")
+
+def create_csv_string(rows, fieldnames):
+    """Writes an iterable of row tuples, ordered as fieldnames, to a CSV formatted string as they are produced.
+    Returns None if the iterable yields no rows."""
+    string_io = io.StringIO()
+    writer = csv.writer(string_io)
+    writer.writerow(fieldnames)
+    header_length = string_io.tell()
+    writer.writerows(rows)
+    if string_io.tell() == header_length:
+        return None
+    return string_io.getvalue()
+
+@st.cache_data
+def get_all_sites():
+    """Fetches all sites for the dropdown menu.
+    Returns a tuple of site names sorted by name, for the selectbox options, and a name-to-ID dict.
+    Raises on any request error, including a failed later page, so a partial list is never cached;
+    call it through run_fetcher."""
+    page_size = 100 # Maximum page size allowed by sites/list
+    list_params = {'size': page_size, 'status': 'Active,Pending'}
+    data = fetch_json("sites/list", list_params)
+    if data and 'sites' in data and 'site' in data['sites']:
+        site_list = data['sites']['site']
+        # The first page reports the total count; fetch any remaining pages concurrently
+        count = data['sites'].get('count', len(site_list))
+        calls = [("sites/list", {**list_params, 'startIndex': start_index}) for start_index in range(page_size, count, page_size)]
+        for page in fetch_concurrently(calls):
+            site_list.extend(page.get('sites', {}).get('site', []))
+        site_list.sort(key=itemgetter('name'))
+        site_ids = {site['name']: site['id'] for site in site_list}
+        return tuple(site_ids), site_ids
+    return ("No sites found",), {"No sites found": None}
+
+# --- 5. Cached Per-Endpoint Fetchers ---
+# st.cache_data is global across sessions: any user repeating the same (site, endpoint, parameters)
+# request within the TTL is served from memory. Fetchers raise on request errors rather than
+# returning None, so failures are never cached.
+@st.cache_data(ttl=3600, show_spinner=False)
+def fetch_site_details(site_id):
+    """Fetches the details of a site."""
+    return fetch_json(f"site/{site_id}/details")
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def fetch_site_energy(site_id, start_date, end_date, time_unit):
+    """Fetches site energy measurements for a date range."""
+    return fetch_json(f"site/{site_id}/energy", {'startDate': start_date.strftime('%Y-%m-%d'), 'endDate': end_date.strftime('%Y-%m-%d'), 'timeUnit': time_unit})
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def fetch_site_power(site_id, start_date, start_time, end_date, end_time):
+    """Fetches site power measurements for a date and time range."""
+    return fetch_json(f"site/{site_id}/power", {'startTime': fmt_dt(start_date, start_time), 'endTime': fmt_dt(end_date, end_time)})
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def fetch_sensor_list(site_id):
+    """Fetches the list of sensors installed in a site."""
+    return fetch_json(f"equipment/{site_id}/sensors")
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def fetch_sensor_data(site_id, start_date, end_date):
+    """Fetches sensor measurements for a date range."""
+    # The sensors API is limited to one week per request, so longer ranges are fetched as concurrent weekly windows
+    calls = [(f"site/{site_id}/sensors", {'startDate': start.strftime('%Y-%m-%d'), 'endDate': end.strftime('%Y-%m-%d')})
+             for start, end in split_date_range(start_date, end_date, 7)]
+    results = fetch_concurrently(calls)
+    # Merged from the weekly responses, so the raw download is not a single server response
+    return {'siteSensors': {'data': [gateway for result in results for gateway in result.get('siteSensors', {}).get('data', [])]}}
+
+def meter_rows(meters, time_unit, unit):
+    """Yields one CSV row per meter value."""
+    for meter in meters:
+        for value_entry in meter.get('values', []):
+            yield (value_entry.get('date'), value_entry.get('value'), meter.get('meterSerialNumber'), meter.get('model'), meter.get('meterType'), time_unit, unit)
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def fetch_meters_data(site_id, start_date, end_date, time_unit):
+    """Fetches meter energy details for a date range."""
+    return fetch_json(f"site/{site_id}/meters", {'startTime': fmt_dt(start_date, time(0, 0)), 'endTime': fmt_dt(end_date, time(23, 59)), 'timeUnit': time_unit})
+
+def run_fetcher(fetcher, *args):
+    """Runs a cached fetcher, showing any request error to the user and returning None on failure."""
+    if not api_key_configured():
+        return None
+    try:
+        return fetcher(*args)
+    except requests.exceptions.RequestException as e:
+        # Log the full technical error for the administrator
+        logging.error("API Error in '%s': %s", fetcher.__name__, e)
+        show_api_error(e)
+        return None
+
+@st.cache_resource
+def get_recent_sites():
+    """Returns the process-wide {username: [site_id, ...]} record of each user's most recently used sites.
+    Unlike st.session_state, it survives logging in again from a new browser session."""
+    return {}
+
+def remember_site(username, site_id):
+    """Moves site_id to the front of the user's recently used sites, keeping at most five."""
+    recent_sites = get_recent_sites()
+    previous = recent_sites.get(username, [])
+    recent_sites[username] = [site_id] + [recent_id for recent_id in previous if recent_id != site_id][:4]
+
+def prefetch_site_details(site_ids):
+    """Warms the fetch_site_details cache in the background, without waiting for the results.
+    Workers carry the current script run context so the cached call runs as it would on the main thread.
+    Failures are left in their futures; the regular fetch reports them if the site is requested."""
+    executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS, initializer=add_script_run_ctx, initargs=(None, get_script_run_ctx()))
+    for site_id in site_ids:
+        executor.submit(fetch_site_details, site_id)
+    executor.shutdown(wait=False)
+
+# --- 6. Login Function ---
 def check_login():
     """Displays a login form and handles authentication."""
     st.title("☀️ SolarEdge Data Downloader")
@@ -35,6 +270,7 @@ def check_login():
                 user_index = stored_usernames.index(username)
                 if stored_passwords[user_index] == password:
                     st.session_state["authenticated"] = True
+                    st.session_state["username"] = username
                     st.rerun()
                 else:
                     st.error("Invalid username or password")
@@ -42,7 +278,7 @@ def check_login():
                 st.error("Invalid username or password")
     return False
 
-# --- 4. Main Application ---
+# --- 7. Main Application ---
 def run_app():
     """The main data downloader application, shown after successful login."""
 
@@ -55,60 +291,9 @@ def run_app():
         st.write("") # Spacer
         if st.button("Logout", use_container_width=True):
             st.session_state["authenticated"] = False
+            st.session_state.pop("details_prefetched", None)
             st.rerun()
             
-    def make_api_call(endpoint, params=None):
-        """Makes an API call and returns the JSON response with intelligent error handling."""
-        base_url = "https://monitoringapi.solaredge.com"
-        full_url = f"{base_url}/{endpoint}"
-        if params is None:
-            params = {}
-            
-        api_key = st.secrets.get("solaredge", {}).get("api_key")
-        if not api_key:
-            st.error("API key not found in secrets. Please have the administrator configure it.")
-            return None
-        params['api_key'] = api_key
-        
-        try:
-            response = requests.get(full_url, params=params)
-            response.raise_for_status() # Raises an exception for 4xx or 5xx status codes
-            return response.json()
-        except requests.exceptions.RequestException as e:
-            # Log the full technical error for the administrator
-            logging.error(f"API Error on endpoint '{endpoint}': {e}")
-            
-            # --- Intelligent, User-Facing Error Logic ---
-            if e.response is not None:
-                # Check for the specific date-range error
-                response_text = e.response.text.lower()
-                if e.response.status_code == 403 and "date range" in response_text and "maximum" in response_text:
-                    st.error("The date range you selected is too long for the requested Time Unit. Please select a shorter period and try again.")
-                else:
-                    # Generic error for other API issues
-                    st.error(f"An API error occurred (Code: {e.response.status_code}). Please check your parameters and try again.")
-            else:
-                # Error for network issues where there's no response
-                st.error("Could not connect to the SolarEdge server. Please check your network connection and try again.")
-            return None
-
-    def create_csv_string(data, fieldnames):
-        """Converts a list of dictionaries to a CSV formatted string."""
-        string_io = io.StringIO()
-        writer = csv.DictWriter(string_io, fieldnames=fieldnames, extrasaction='ignore')
-        writer.writeheader()
-        writer.writerows(data)
-        return string_io.getvalue()
-
-    @st.cache_data
-    def get_all_sites():
-        """Fetches all sites for the dropdown menu."""
-        data = make_api_call("sites/list", params={'size': 100, 'status': 'Active,Pending'})
-        if data and 'sites' in data and 'site' in data['sites']:
-            site_list = data['sites']['site']
-            return {site['name']: site['id'] for site in sorted(site_list, key=lambda x: x['name'])}
-        return {"No sites found": None}
-
     # Define API endpoint descriptions
     endpoint_descriptions = {
         "Site Details": "Details of a chosen site.",
@@ -120,9 +305,17 @@ def run_app():
     }
     
     # --- UI Elements ---
-    all_sites_dict = get_all_sites()
+    all_sites = run_fetcher(get_all_sites)
+    site_names, site_ids = all_sites if all_sites is not None else (("No sites found",), {"No sites found": None})
+    # Once per login, warm the details cache for this user's recently used sites so the first click is instant
+    if not st.session_state.get("details_prefetched"):
+        st.session_state["details_prefetched"] = True
+        recent_sites = get_recent_sites().get(st.session_state.get("username"), [])
+        if recent_sites and st.secrets.get("solaredge", {}).get("api_key"):
+            prefetch_site_details(recent_sites)
     st.subheader("1. Select Site and API Endpoint")
-    selected_site_name = st.selectbox("Select a Site:", options=list(all_sites_dict.keys()))
+    selected_site_name = st.selectbox("Select a Site:", options=site_names)
+    selected_site_id = site_ids.get(selected_site_name)
     
     api_endpoints = list(endpoint_descriptions.keys())
     selected_endpoint = st.selectbox("Select the API Endpoint:", options=api_endpoints, help="Choose the data you want to download.")
@@ -153,103 +346,119 @@ def run_app():
         params['time_unit'] = st.selectbox("Time Unit", ["DAY", "QUARTER_OF_AN_HOUR", "HOUR", "WEEK", "MONTH", "YEAR"])
 
     st.subheader("3. Generate Files")
+    compress_downloads = False
+    if zstd is not None:
+        compress_downloads = st.checkbox("Compress downloads (.zst)", help="Smaller files for long date ranges. Requires a zstd-capable tool to open.")
+    # Identifies the selection the stashed downloads were generated for
+    download_key = (selected_site_id, selected_endpoint, tuple(sorted(params.items())), compress_downloads)
     if st.button("Generate Download Files", type="primary"):
-        selected_site_id = all_sites_dict.get(selected_site_name)
         if not selected_site_id:
             st.error("Invalid site selected.")
             st.stop()
+        remember_site(st.session_state.get("username"), selected_site_id)
 
         with st.spinner(f"Fetching data for '{selected_endpoint}'..."):
             api_data = None
-            processed_data = []
-            fieldnames = []
+            # Rows are generated lazily and written straight into the CSV buffer
+            rows = None
+            fieldnames = FIELDNAMES.get(selected_endpoint, ())
             
-            # --- API Logic for each endpoint... (This section remains unchanged) ---
+            # --- API Logic for each endpoint ---
             if selected_endpoint == "Site Details":
-                api_data = make_api_call(f"site/{selected_site_id}/details")
+                api_data = run_fetcher(fetch_site_details, selected_site_id)
                 if api_data and 'details' in api_data:
-                    details = api_data['details']
-                    if 'location' in details and isinstance(details['location'], dict):
-                        location_data = details.pop('location')
-                        details.update({f"location_{k}": v for k, v in location_data.items()})
-                    if 'publicSettings' in details and isinstance(details['publicSettings'], dict):
-                         public_settings = details.pop('publicSettings')
-                         details.update({f"public_{k}": v for k, v in public_settings.items()})
-                    if 'uris' in details and isinstance(details['uris'], dict):
-                        uris = details.pop('uris')
-                        details.update({f"uri_{k.lower().replace(' ', '_')}": v for k, v in uris.items()})
-                    processed_data = [details]
+                    # Flatten the nested sections in one pass, leaving api_data untouched for the raw JSON
+                    raw_details = api_data['details']
+                    nested_prefixes = {'location': 'location', 'publicSettings': 'public', 'uris': 'uri'}
+                    nested = {k: raw_details[k] for k in nested_prefixes if isinstance(raw_details.get(k), dict)}
+                    details = {k: v for k, v in raw_details.items() if k not in nested}
+                    details.update({f"{nested_prefixes[k]}_{ik.lower().replace(' ', '_') if k == 'uris' else ik}": v
+                                    for k, sub in nested.items() for ik, v in sub.items()})
                     fieldnames = sorted(details.keys())
+                    rows = [tuple(details[key] for key in fieldnames)]
             elif selected_endpoint in ["Site Energy", "Site Power"]:
                 endpoint_url = "energy" if selected_endpoint == "Site Energy" else "power"
                 if selected_endpoint == "Site Energy":
-                    api_params = {'startDate': params['start_date'].strftime('%Y-%m-%d'), 'endDate': params['end_date'].strftime('%Y-%m-%d'), 'timeUnit': params['time_unit']}
+                    api_data = run_fetcher(fetch_site_energy, selected_site_id, params['start_date'], params['end_date'], params['time_unit'])
                 else:
-                    start_dt = datetime.combine(params['start_date_power'], params['start_time_power'])
-                    end_dt = datetime.combine(params['end_date_power'], params['end_time_power'])
-                    api_params = {'startTime': start_dt.strftime('%Y-%m-%d %H:%M:%S'), 'endTime': end_dt.strftime('%Y-%m-%d %H:%M:%S')}
-                api_data = make_api_call(f"site/{selected_site_id}/{endpoint_url}", params=api_params)
+                    api_data = run_fetcher(fetch_site_power, selected_site_id, params['start_date_power'], params['start_time_power'], params['end_date_power'], params['end_time_power'])
                 if api_data and api_data.get(endpoint_url, {}).get('values'):
-                    base_info = {'timeUnit': api_data[endpoint_url].get('timeUnit'), 'unit': api_data[endpoint_url].get('unit')}
-                    processed_data = [{**base_info, **v} for v in api_data[endpoint_url]['values']]
-                    fieldnames = ['date', 'value', 'timeUnit', 'unit']
+                    time_unit, unit = api_data[endpoint_url].get('timeUnit'), api_data[endpoint_url].get('unit')
+                    rows = ((v.get('date'), v.get('value'), time_unit, unit) for v in api_data[endpoint_url]['values'])
             elif selected_endpoint == "Get Sensor List":
-                api_data = make_api_call(f"equipment/{selected_site_id}/sensors")
+                api_data = run_fetcher(fetch_sensor_list, selected_site_id)
                 if api_data and api_data.get('SiteSensors', {}).get('list'):
-                    for gateway in api_data['SiteSensors']['list']:
-                        for sensor in gateway.get('sensors', []):
-                            processed_data.append({'gateway': gateway.get('connectedTo'), 'name': sensor.get('name'), 'measurement': sensor.get('measurement'), 'type': sensor.get('type')})
-                    if processed_data:
-                        fieldnames = ['gateway', 'name', 'measurement', 'type']
+                    rows = ((gateway.get('connectedTo'), sensor.get('name'), sensor.get('measurement'), sensor.get('type'))
+                            for gateway in api_data['SiteSensors']['list']
+                            for sensor in gateway.get('sensors', []))
             elif selected_endpoint == "Get Sensor Data":
-                api_params = {'startDate': params['start_date'].strftime('%Y-%m-%d'), 'endDate': params['end_date'].strftime('%Y-%m-%d')}
-                api_data = make_api_call(f"site/{selected_site_id}/sensors", params=api_params)
+                if params['start_date'] > params['end_date']:
+                    st.error("The start date must be on or before the end date.")
+                    st.stop()
+                if (params['end_date'] - params['start_date']).days >= MAX_SENSOR_DATA_DAYS:
+                    st.error(f"Sensor data can be downloaded for at most {MAX_SENSOR_DATA_DAYS} days at a time. Please select a shorter period and try again.")
+                    st.stop()
+                api_data = run_fetcher(fetch_sensor_data, selected_site_id, params['start_date'], params['end_date'])
                 if api_data and api_data.get('siteSensors', {}).get('data'):
-                    for gateway in api_data['siteSensors']['data']:
-                        gateway_name = gateway.get('connectedTo')
-                        for telemetry in gateway.get('telemetries', []):
-                            entry_date = telemetry.pop('date', None)
-                            for key, value in telemetry.items():
-                                processed_data.append({'gateway': gateway_name, 'date': entry_date, 'measurement_type': key, 'value': value})
-                    if processed_data:
-                        fieldnames = ['gateway', 'date', 'measurement_type', 'value']
+                    # Telemetries are read without popping 'date' so the raw JSON keeps it
+                    rows = ((gateway.get('connectedTo'), telemetry.get('date'), key, value)
+                            for gateway in api_data['siteSensors']['data']
+                            for telemetry in gateway.get('telemetries', [])
+                            for key, value in telemetry.items() if key != 'date')
             elif selected_endpoint == "Get Meters Data":
-                start_dt = datetime.combine(params['start_date'], time(0, 0))
-                end_dt = datetime.combine(params['end_date'], time(23, 59))
-                api_params = {'startTime': start_dt.strftime('%Y-%m-%d %H:%M:%S'), 'endTime': end_dt.strftime('%Y-%m-%d %H:%M:%S'), 'timeUnit': params['time_unit']}
-                api_data = make_api_call(f"site/{selected_site_id}/meters", params=api_params)
+                api_data = run_fetcher(fetch_meters_data, selected_site_id, params['start_date'], params['end_date'], params['time_unit'])
                 if api_data and api_data.get('meterEnergyDetails', {}).get('meters'):
-                    base_info = {'timeUnit': api_data['meterEnergyDetails'].get('timeUnit'), 'unit': api_data['meterEnergyDetails'].get('unit')}
-                    for meter in api_data['meterEnergyDetails']['meters']:
-                        meter_info = {'meterSerialNumber': meter.get('meterSerialNumber'), 'model': meter.get('model'), 'meterType': meter.get('meterType')}
-                        for value_entry in meter.get('values', []):
-                            processed_data.append({**base_info, **meter_info, **value_entry})
-                    if processed_data:
-                        fieldnames = ['date', 'value', 'meterSerialNumber', 'model', 'meterType', 'timeUnit', 'unit']
-
-            # --- Display Download Buttons ---
-            if api_data and processed_data:
-                st.success("✅ Your files are ready to download below!")
+                    meter_details = api_data['meterEnergyDetails']
+                    rows = meter_rows(meter_details['meters'], meter_details.get('timeUnit'), meter_details.get('unit'))
+
+            processed_csv_string = create_csv_string(rows, fieldnames) if rows is not None else None
+
+            # Serialize once per click; later reruns reuse the stashed bytes
+            st.session_state.pop("downloads", None)
+            if processed_csv_string:
                 today_str = datetime.now().strftime("%m%d%y")
                 time_unit_str = f"_{params['time_unit'].lower()}" if 'time_unit' in params else ""
                 base_filename = f'solaredge_{selected_site_id}_{selected_endpoint.replace(" ", "_").lower()}{time_unit_str}_{today_str}'
-                raw_json_string = json.dumps(api_data, indent=4)
-                processed_csv_string = create_csv_string(processed_data, fieldnames)
-                col1, col2 = st.columns(2)
-                with col1:
-                    st.download_button(label="Download Processed CSV", data=processed_csv_string, file_name=f"{base_filename}.csv", mime='text/csv')
-                with col2:
-                    st.download_button(label="Download Raw JSON", data=raw_json_string, file_name=f"{base_filename}_raw.json", mime='application/json')
+                csv_bytes = processed_csv_string.encode("utf-8")
+                # Sensor data is merged from several weekly responses rather than returned as one
+                json_suffix = "_merged" if selected_endpoint == "Get Sensor Data" else "_raw"
+                json_bytes = to_json_bytes(api_data)
+                if compress_downloads:
+                    compressor = zstd.ZstdCompressor(level=3)
+                    st.session_state["downloads"] = {
+                        'key': download_key,
+                        'csv': (compressor.compress(csv_bytes), f"{base_filename}.csv.zst", 'application/zstd'),
+                        'json': (compressor.compress(json_bytes), f"{base_filename}{json_suffix}.json.zst", 'application/zstd'),
+                    }
+                else:
+                    st.session_state["downloads"] = {
+                        'key': download_key,
+                        'csv': (csv_bytes, f"{base_filename}.csv", 'text/csv'),
+                        'json': (json_bytes, f"{base_filename}{json_suffix}.json", 'application/json'),
+                    }
             elif api_data is None:
                 pass 
             else:
                 st.warning(f"The request was successful, but no data was found for '{selected_endpoint}' on this site with the selected parameters. This could be normal for sites without the specified equipment or for time periods with no data.")
 
+    # --- Display Download Buttons ---
+    # Shown from the stash so the files survive the rerun triggered by clicking a download button
+    downloads = st.session_state.get("downloads")
+    if downloads and downloads['key'] == download_key:
+        st.success("✅ Your files are ready to download below!")
+        col1, col2 = st.columns(2)
+        with col1:
+            csv_data, csv_name, csv_mime = downloads['csv']
+            st.download_button(label="Download Processed CSV", data=csv_data, file_name=csv_name, mime=csv_mime)
+        with col2:
+            json_data, json_name, json_mime = downloads['json']
+            st.download_button(label="Download Raw JSON", data=json_data, file_name=json_name, mime=json_mime)
+
     # --- Footer ---
     st.markdown("---")
     st.markdown("<i>For support or technical issues, please raise a ticket via the <a href='https://helpdesk.lopezgroup.com.ph/' target='_blank'>Service Desk Portal</a>.</i>", unsafe_allow_html=True)
 
-# --- 5. App Entry Point ---
+# --- 8. App Entry Point ---
 if not st.session_state.get("authenticated", False):
     check_login()
 else: